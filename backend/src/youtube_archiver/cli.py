@@ -1,10 +1,17 @@
 import argparse
 import logging
 import pathlib
-from sys import stderr
+from sys import stderr, stdout, version_info
+from typing import Any, Dict
 
-from .downloader import download
-from .server import server
+from .custom_types import DownloadResult
+
+# Python 3.14+ re-checks several environment variables for colorized help on every `add_argument` call.  Colors are
+# normally not emitted when stdout isn't a terminal (or is missing, e.g. under pythonw) so skip the checks in that case.
+# This does mean FORCE_COLOR is ignored when the output is piped.
+_PARSER_KWARGS: Dict[str, Any] = (
+    {"color": False} if version_info >= (3, 14) and (stdout is None or not stdout.isatty()) else {}
+)
 
 
 def server_cli() -> int:
@@ -13,38 +20,46 @@ def server_cli() -> int:
 
     :return: 0 on success
     """
-    parser = argparse.ArgumentParser(description="Backend API server for YouTube Archive")
+    parser = argparse.ArgumentParser(description="Backend API server for YouTube Archive", **_PARSER_KWARGS)
     parser.add_argument("--port", default=8081, help="TCP port to bind to")
     parser.add_argument("--download-dir", required=True, type=pathlib.Path, help="Path to the download directory")
     parser.add_argument(
         "--downloads-prefix", default="/downloads", help="Path/string to prepend to generated download links"
     )
     parser.add_argument("--ffmpeg-dir", type=pathlib.Path, help="Directory containing FFMPEG")
+    parser.add_argument(
+        "--tmp-dir",
+        type=pathlib.Path,
+        help="Directory for in-progress downloads (e.g. a tmpfs mount), needs room for the largest download",
+    )
     parser.add_argument(
         "--logging", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], default="INFO", help="Logging level"
     )
 
     args = parser.parse_args()
 
+    # Imported here so that "--help" and argument errors don't pay for loading aiohttp and youtube-dl
+    from .server import LOG_FORMAT, server
+
     log_level = getattr(logging, args.logging)
-    logging.basicConfig(level=log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
     ytdl_logger = logging.getLogger("ytdl")
     # Things that youtube-dl considers warnings can be squelched
     ytdl_logger.setLevel(level=max(logging.ERROR, log_level))
 
-    server(args.download_dir, args.downloads_prefix, args.port, args.ffmpeg_dir)
+    server(args.download_dir, args.downloads_prefix, args.port, args.ffmpeg_dir, args.tmp_dir)
 
     return 0
 
 
 def download_cli() -> int:
     """
-    Quasi-debugging CLI entrypoint that uses youtube-dl to download a video/audio clip.
+    Quasi-debugging CLI entrypoint that uses youtube-dl to download one or more video/audio clips.
 
-    :return: 0 on success
+    :return: 0 on success, 1 if any URL failed
     """
-    parser = argparse.ArgumentParser(description="Backend API server for YouTube Archive")
-    parser.add_argument("url", help="URL to process")
+    parser = argparse.ArgumentParser(description="Backend API server for YouTube Archive", **_PARSER_KWARGS)
+    parser.add_argument("url", nargs="+", help="URL(s) to process")
     parser.add_argument(
         "-o",
         "--output-dir",
@@ -58,6 +73,12 @@ def download_cli() -> int:
     parser.add_argument("--extract-audio", action="store_true", help="Save audio as a MP3")
     parser.add_argument("--audio-vbr", default=5, type=int, help="MP3 VBR quality")
     parser.add_argument("--ffmpeg-dir", type=pathlib.Path, help="Directory containing FFMPEG")
+    parser.add_argument(
+        "--tmp-dir",
+        type=pathlib.Path,
+        help="Directory for in-progress downloads (e.g. a tmpfs mount), needs room for the largest download",
+    )
+    parser.add_argument("-j", "--jobs", default=4, type=int, help="Maximum number of URLs to download concurrently")
 
     args = parser.parse_args()
 
@@ -65,7 +86,13 @@ def download_cli() -> int:
         print("You must extract at least video or audio", file=stderr)
         return 1
 
-    download_results = download(
+    if args.jobs < 1:
+        print("You must allow at least 1 concurrent download", file=stderr)
+        return 1
+
+    from .downloader import download_many
+
+    results = download_many(
         args.output_dir,
         args.named_subdir,
         args.url,
@@ -73,13 +100,22 @@ def download_cli() -> int:
         args.extract_audio,
         args.audio_vbr,
         ffmpeg_dir=args.ffmpeg_dir,
+        tmp_dir=args.tmp_dir,
+        max_workers=min(args.jobs, len(args.url)),
     )
 
-    print(f'Successfully processed "{download_results.pretty_name}"')
-    print(f"\t Info File: {download_results.info_file}")
-    if not args.skip_video:
-        print(f"\tVideo File: {download_results.video_file}")
-    if args.extract_audio:
-        print(f"\tAudio File: {download_results.audio_file}")
-
-    return 0
+    ret_code = 0
+    for url, download_results in results.items():
+        if not isinstance(download_results, DownloadResult):
+            print(f'Failed to process "{url}": {download_results}', file=stderr)
+            ret_code = 1
+            continue
+
+        print(f'Successfully processed "{download_results.pretty_name}"')
+        print(f"\t Info File: {download_results.info_file}")
+        if not args.skip_video:
+            print(f"\tVideo File: {download_results.video_file}")
+        if args.extract_audio:
+            print(f"\tAudio File: {download_results.audio_file}")
+
+    return ret_code
@@ -1,5 +1,5 @@
 import sys
-from enum import Enum, auto
+from enum import Enum
 from pathlib import Path
 from typing import NamedTuple, Optional, Union
 
@@ -9,14 +9,18 @@ else:
     from mypy_extensions import Literal, TypedDict
 
 
-class UpdateStatusCode(Enum):
-    """Enum for the various update message status values."""
+class UpdateStatusCode(str, Enum):
+    """
+    Enum for the various update message status values.
 
-    COMPLETED = auto()
-    DELETED = auto()
-    DOWNLOADED = auto()
-    DOWNLOADING = auto()
-    ERROR = auto()
+    Members are also plain strings (equal to their names) so update messages serialize to JSON as-is.
+    """
+
+    COMPLETED = "COMPLETED"
+    DELETED = "DELETED"
+    DOWNLOADED = "DOWNLOADED"
+    DOWNLOADING = "DOWNLOADING"
+    ERROR = "ERROR"
 
 
 class DownloadResult(NamedTuple):
@@ -53,7 +57,7 @@ class _DownloadedUpdateNoReqID(TypedDict):
     """Realtime update message indicating a file was downloaded."""
 
     status: Literal[UpdateStatusCode.DOWNLOADED]
-    filename: Path
+    filename: str
 
 
 class DownloadedUpdate(_DownloadedUpdateNoReqID, total=False):
@@ -66,7 +70,7 @@ class _DownloadingUpdateNoReqID(TypedDict):
     """Realtime update message indicating a file is downloading."""
 
     status: Literal[UpdateStatusCode.DOWNLOADING]
-    filename: Path
+    filename: str
     downloaded_bytes: int
     total_bytes: Optional[int]
 
@@ -1,27 +1,46 @@
 from __future__ import annotations
 
+import errno
 import json
 import logging
 import os
 import shutil
-from functools import partial
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from functools import lru_cache, partial
 from pathlib import Path
-from subprocess import run  # noqa: S404
-from tempfile import mkdtemp
-from typing import Any, Dict, List, Optional, Tuple
-
-from janus import Queue
-from youtube_dl import YoutubeDL
-from youtube_dl.postprocessor.ffmpeg import FFmpegMergerPP, encodeArgument, encodeFilename, prepend_extension
-from youtube_dl.utils import sanitize_filename
+from subprocess import DEVNULL, PIPE, run  # noqa: S404
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Callable, DefaultDict, Dict, Iterable, List, Optional, Tuple, Type, Union
 
 from .custom_types import DownloadedUpdate, DownloadingUpdate, DownloadResult, UpdateMessage, UpdateStatusCode
 
+# youtube-dl takes a significant fraction of a second to import so it's only imported where it is actually used.  This
+# keeps importing this module (e.g. by the API server at startup or the parent process of `download_many`) cheap.
+if TYPE_CHECKING:
+    from multiprocessing.queues import Queue
+
+    from youtube_dl.postprocessor.ffmpeg import FFmpegMergerPP
+
 logger = logging.getLogger(__name__)
 # youtube-dl irritatingly prints log messages directly to stderr/stdout if you don't give it a logger
 ytdl_logger = logging.getLogger("ytdl")
 ytdl_logger.addHandler(logging.NullHandler())
 
+# youtube-dl options that are the same for every download.  Setting both the automatic subs and manual subs is fine,
+# youtube-dl will prefer manual subs if present.
+_BASE_YTDL_OPT: Dict[str, Any] = {
+    "noplaylist": "true",
+    "merge_output_format": "mkv",
+    "logger": ytdl_logger,
+    "writeinfojson": True,
+    "writesubtitles": True,
+    "writeautomaticsub": True,
+    "subtitleslangs": ["en"],
+}
+
 
 class AlreadyDownloaded(RuntimeError):
     """Custom exception to indicate that a file/directory already exists, aka it was already downloaded."""
@@ -36,9 +55,67 @@ class AlreadyDownloaded(RuntimeError):
         super().__init__(msg)
         self.key = key
 
+    def __reduce__(self) -> Tuple[Type[AlreadyDownloaded], Tuple[str, str]]:
+        """
+        Pickle support, required for the exception to cross process boundaries (e.g. from a `ProcessPoolExecutor`).
+
+        :return: The class and constructor arguments to recreate this exception
+        """
+        return self.__class__, (str(self), self.key)
+
+
+def _files_by_suffix(directory: Path) -> DefaultDict[str, List[Path]]:
+    """
+    Groups the files in `directory` by their suffix using a single directory scan.
+
+    :param directory: Directory to scan (non-recursively)
+    :return: Mapping of suffix, including the leading dot, to the files with that suffix.  Missing suffixes map to [].
+    """
+    files_by_suffix: DefaultDict[str, List[Path]] = defaultdict(list)
+    with os.scandir(directory) as it:
+        for entry in it:
+            files_by_suffix[os.path.splitext(entry.name)[1]].append(Path(entry.path))
+
+    return files_by_suffix
+
+
+def _move_file(src: Path, dst: Path) -> Path:
+    """
+    Moves `src` to `dst`, atomically replacing `dst` if it already exists.
+
+    :param src: File to move
+    :param dst: Destination path, including filename
+    :return: `dst`
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        # The temporary download directory frequently lives on a different filesystem than the output directory
+        if exc.errno != errno.EXDEV:
+            raise
+
+        # Copy next to the destination and rename over it so `dst` is never seen partially written.  Unlike
+        # `shutil.move`, `shutil.copyfile` skips copying the metadata of what is only a temporary file and uses
+        # `sendfile` where available so the data doesn't bounce through user space.
+        partial_dst = dst.with_name(f".{dst.name}.part")
+        try:
+            shutil.copyfile(src, partial_dst)
+            os.replace(partial_dst, dst)
+        except BaseException:  # noqa: B902
+            with suppress(FileNotFoundError):
+                partial_dst.unlink()
+            raise
+        src.unlink()
+
+    return dst
+
 
 def process_output_dir(
-    download_dir: Path, output_dir: Path, download_video: bool, extract_audio: bool
+    download_dir: Path,
+    output_dir: Path,
+    download_video: bool,
+    extract_audio: bool,
+    metadata: Optional[Dict[str, Any]] = None,
 ) -> DownloadResult:
     """
     Parses the output from a youtube-dl run and determines which files are the finalized video and/or audio files.
@@ -49,6 +126,7 @@ def process_output_dir(
     :param output_dir: Desired output directory
     :param download_video: Flag indicating whether video is to be retained
     :param extract_audio: Flag indicating whether audio is to be retained
+    :param metadata: The youtube-dl info dict, if already in memory, to avoid re-parsing the info JSON file
     :return: Tuple containing information and finalized paths for all the files
     """
     # youtube-dl has a really janky API that returns very little information in terms of what was actually downloaded.
@@ -58,71 +136,121 @@ def process_output_dir(
     #  * If video was requested but the source doesn't support separate bestvideo and bestaudio, the video file will be
     #    whatever file was downloaded (using best)
     # We additionally had to tell youtube-dl to not delete intermediate files if we wanted audio so clear those out.
-    info_file = list(download_dir.glob("*.json"))[0]
-    with info_file.open() as f_in:
-        metadata = json.load(f_in)
+    from youtube_dl.utils import sanitize_filename
+
+    files_by_suffix = _files_by_suffix(download_dir)
+
+    info_file = files_by_suffix[".json"][0]
+    if metadata is None:
+        with info_file.open() as f_in:
+            metadata = json.load(f_in)
 
     pretty_name = metadata["title"]
     sanitized_title = sanitize_filename(pretty_name)
 
-    # This was touched during existence checks if subdirectories aren't being made.  If the file exists, it's fine.
-    try:
-        shutil.move(str(info_file), str(output_dir / f"{sanitized_title}.json"))
-        info_file = output_dir / f"{sanitized_title}.json"
-    except FileExistsError:
-        pass
+    # This was touched during existence checks if subdirectories aren't being made so it's fine to overwrite it.
+    info_file = _move_file(info_file, output_dir / f"{sanitized_title}.json")
 
     audio_file: Optional[Path] = None
     if extract_audio:
-        audio_file = list(download_dir.glob("*.mp3"))[0]
-        shutil.move(str(audio_file), str(output_dir / f"{sanitized_title}{audio_file.suffix}"))
-        audio_file = output_dir / f"{sanitized_title}{audio_file.suffix}"
+        audio_file = files_by_suffix[".mp3"][0]
+        audio_file = _move_file(audio_file, output_dir / f"{sanitized_title}{audio_file.suffix}")
 
     video_file: Optional[Path] = None
     # Audio identification performed first otherwise the mp3 would be picked as the fallback option if no mkv present
     if download_video:
-        try:
+        if files_by_suffix[".mkv"]:
             # Conceivably there are two mkv files, choose the one with the shortest name as youtube-dl includes the
             # format number in the original filename but not the merged output name.
-            video_file = sorted(download_dir.glob("*.mkv"), key=lambda x: len(x.name))[0]
-        except IndexError:
+            video_file = min(files_by_suffix[".mkv"], key=lambda x: len(x.name))
+        else:
             # If a merge didn't happen, search for the downloaded streams for one that contains video.  Just assume
             # that only 1 format was downloaded that had video and use it.
-            for requested_format in metadata["requested_formats"]:
+            for requested_format in metadata.get("requested_formats", []):
                 if requested_format["vcodec"] != "none":
-                    video_file = list(download_dir.glob(f"*.{requested_format['ext']}"))[0]
+                    video_file = files_by_suffix[f".{requested_format['ext']}"][0]
                     break
 
         if video_file is not None:
-            shutil.move(str(video_file), str(output_dir / f"{sanitized_title}{video_file.suffix}"))
-            video_file = output_dir / f"{sanitized_title}{video_file.suffix}"
+            video_file = _move_file(video_file, output_dir / f"{sanitized_title}{video_file.suffix}")
 
     return DownloadResult(pretty_name, sanitized_title, info_file, video_file, audio_file)
 
 
-def process_hook(updates_queue: Queue[UpdateMessage], update: Dict[str, str], req_id: Optional[str] = None) -> None:
+class ProgressThrottle:
+    """Coalesces youtube-dl's rapid-fire "downloading" progress updates down to at most one per file per interval."""
+
+    def __init__(self, min_interval: float = 0.25) -> None:
+        """
+        Constructor.
+
+        :param min_interval: Minimum number of seconds between progress updates for the same file
+        """
+        self.min_interval = min_interval
+        self._last_sent: Dict[str, float] = {}
+
+    def should_send(self, filename: str) -> bool:
+        """
+        Determines whether a progress update for `filename` should be sent, recording it as sent if so.
+
+        Skipped updates carry no information that the next sent update won't supersede.
+
+        :param filename: The file the progress update is for
+        :return: True if `min_interval` has elapsed since the last sent update for `filename`
+        """
+        now = monotonic()
+        last_sent = self._last_sent.get(filename)
+        if last_sent is not None and now - last_sent < self.min_interval:
+            return False
+
+        self._last_sent[filename] = now
+        return True
+
+
+def process_hook(
+    updates_queue: Queue[UpdateMessage],
+    update: Dict[str, str],
+    req_id: Optional[str] = None,
+    throttle: Optional[ProgressThrottle] = None,
+) -> None:
     """
     A youtube-dl progress callback hook that puts a slightly reformated update into the `update_queue`.
 
     :param updates_queue: The queue to put the modified update into
     :param update: The received update from youtube-dl
     :param req_id: Optional request ID that is inserted into the status message as "req_id"
+    :param throttle: Optional rate limiter for "downloading" updates, "finished" updates are always sent
     """
     if update["status"] == "downloading":
+        if throttle is not None and not throttle.should_send(update["filename"]):
+            return
+
         downloading_msg: DownloadingUpdate = {
             "status": UpdateStatusCode.DOWNLOADING,
-            "filename": Path(update["filename"]),
+            "filename": update["filename"],
             "downloaded_bytes": int(update["downloaded_bytes"]),
             "total_bytes": int(update["total_bytes"]) if update.get("total_bytes") else None,
         }
         if req_id is not None:
             downloading_msg["req_id"] = req_id
-        updates_queue.sync_q.put_nowait(downloading_msg)
+        updates_queue.put_nowait(downloading_msg)
     elif update["status"] == "finished":
-        downloaded_msg: DownloadedUpdate = {"status": UpdateStatusCode.DOWNLOADED, "filename": Path(update["filename"])}
+        downloaded_msg: DownloadedUpdate = {"status": UpdateStatusCode.DOWNLOADED, "filename": update["filename"]}
         if req_id is not None:
             downloaded_msg["req_id"] = req_id
-        updates_queue.sync_q.put_nowait(downloaded_msg)
+        updates_queue.put_nowait(downloaded_msg)
+
+
+@lru_cache(maxsize=None)
+def _pick_aac_encoder(executable: str) -> str:
+    """
+    Determines which AAC encoder to use, checking only once per FFmpeg executable.
+
+    :param executable: Path to the FFmpeg executable
+    :return: "libfdk_aac" if the Fraunhofer FDK AAC codec is available, otherwise "aac"
+    """
+    encoders_output = run([executable, "-encoders"], stdout=PIPE, stderr=DEVNULL, check=False)  # noqa: S603
+    return "libfdk_aac" if encoders_output.stdout.find(b"libfdk_aac") != -1 else "aac"
 
 
 def _ffmpeg_monkey_patch(
@@ -131,24 +259,50 @@ def _ffmpeg_monkey_patch(
     """
     A rather gross monkey patch to hack in the ability to transcode merged audio to AAC if necessary.
 
+    If a MP3 will also be extracted from the merged file, it is produced by the same FFmpeg invocation as a second
+    output so the audio is only decoded once.  The audio extraction post-processor then skips the existing MP3 file.
+
     :param self: This monkey patch is for a class method so this is the normal "self" parameter
     :param info: This is expected by the original method
     :param quality: Extra argument added by the monkey patch, the AAC VBR quality (1-5)
     :return: The expected original method output
     """
+    from youtube_dl.postprocessor.ffmpeg import FFmpegExtractAudioPP, encodeFilename, prepend_extension
+
     filename = info["filepath"]
     temp_filename = prepend_extension(filename, "temp")
+    audio_codec = self.get_audio_codec(info["__files_to_merge"][1])
+
+    args: List[str] = []
+    mp3_extractor = next(
+        (
+            pp
+            for pp in self._downloader._pps
+            if isinstance(pp, FFmpegExtractAudioPP) and pp._preferredcodec == "mp3" and pp._nopostoverwrites
+        ),
+        None,
+    )
+    if mp3_extractor is not None:
+        # Same naming and encoding options as the audio extraction post-processor
+        prefix, sep, _ = filename.rpartition(".")
+        if audio_codec == "mp3":
+            args += ["-map", "1:a:0", "-c:a", "copy"]
+        else:
+            args += ["-map", "1:a:0", "-c:a", "libmp3lame"]
+            if mp3_extractor._preferredquality is not None:
+                if int(mp3_extractor._preferredquality) < 10:
+                    args += ["-q:a", mp3_extractor._preferredquality]
+                else:
+                    args += ["-b:a", mp3_extractor._preferredquality + "k"]
+        args.append(self._ffmpeg_filename_argument(prefix + sep + "mp3"))
 
     # Only need to transcode if the source audio isn't already AAC
-    if self.get_audio_codec(info["__files_to_merge"][1]) != "aac":
+    if audio_codec != "aac":
         # Making an assumption that we're using FFmpeg here.  If the Fraunhofer FDK AAC codec is available, prefer it
-        encoders_output = run(  # noqa: S603
-            [encodeFilename(self.executable), encodeArgument("-encoders")], capture_output=True
-        )
-        encoder = "libfdk_aac" if encoders_output.stdout.find(b"libfdk_aac") != -1 else "aac"
-        args = ["-c", "copy", "-map", "0:v:0", "-map", "1:a:0", "-c:a", encoder, "-q:a", str(quality)]
+        encoder = _pick_aac_encoder(self.executable)
+        args += ["-c", "copy", "-map", "0:v:0", "-map", "1:a:0", "-c:a", encoder, "-q:a", str(quality)]
     else:
-        args = ["-c", "copy", "-map", "0:v:0", "-map", "1:a:0"]
+        args += ["-c", "copy", "-map", "0:v:0", "-map", "1:a:0"]
 
     self._downloader.to_screen('[ffmpeg] Merging formats into "%s"' % filename)
     self.run_ffmpeg_multiple_files(info["__files_to_merge"], temp_filename, args)
@@ -156,6 +310,23 @@ def _ffmpeg_monkey_patch(
     return info["__files_to_merge"], info
 
 
+_ffmpeg_patched = False
+
+
+def _install_ffmpeg_monkey_patch() -> None:
+    """Installs :func:`_ffmpeg_monkey_patch` on the youtube-dl merger post-processor if not already installed."""
+    global _ffmpeg_patched
+    if _ffmpeg_patched:
+        return
+
+    from youtube_dl.postprocessor.ffmpeg import FFmpegMergerPP
+
+    # Can monkey patch to add our transcoding functionality unconditionally as the merger post-processor will only be
+    # used if it's necessary.
+    FFmpegMergerPP.run = _ffmpeg_monkey_patch
+    _ffmpeg_patched = True
+
+
 def download(
     output_dir: Path,
     make_title_subdir: bool,
@@ -166,6 +337,7 @@ def download(
     updates_queue: Optional[Queue[UpdateMessage]] = None,
     req_id: Optional[str] = None,
     ffmpeg_dir: Optional[Path] = None,
+    tmp_dir: Optional[Path] = None,
 ) -> DownloadResult:
     """
     Downloads and transcodes (if necessary) a specified online video or audio clip.
@@ -176,48 +348,54 @@ def download(
     :param download_video: Flag indicating that the video should be downloaded
     :param extract_audio: Flag indicating that a separate audio file (MP3) should be created
     :param audio_quality: The MP3 VBR audio quality (1-5)
-    :param updates_queue: A queue to put real-time updates into
+    :param updates_queue: A queue to put real-time updates into, usable across processes
     :param req_id: An optional ID to include in all `updates-queue` related updates
     :param ffmpeg_dir: Path to the directory containing FFMPEG binaries
+    :param tmp_dir: Directory to create the temporary download workspace in, defaults to the system temporary directory
     :return: Tuple containing information and finalized paths for all the files
     """
     if not output_dir.is_dir():
         raise ValueError("output_dir must be a directory")
 
-    postprocessors = [{"key": "FFmpegEmbedSubtitle"}]
+    from youtube_dl import YoutubeDL
+    from youtube_dl.utils import sanitize_filename
+
+    _install_ffmpeg_monkey_patch()
+
+    postprocessors: List[Dict[str, Any]] = [{"key": "FFmpegEmbedSubtitle"}]
     if extract_audio:
         postprocessors.append(
-            {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": str(audio_quality)}
+            {
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": str(audio_quality),
+                # The merge step already creates the MP3 when there is a merge, see `_ffmpeg_monkey_patch`
+                "nopostoverwrites": True,
+            }
         )
 
-    progress_hooks = []
-    if updates_queue:
-        progress_hooks.append(partial(process_hook, updates_queue, req_id=req_id))
-
-    # Can monkey patch to add our transcoding functionality unconditionally as the merger post-processor will only be
-    # used if it's necessary.
-    FFmpegMergerPP.run = _ffmpeg_monkey_patch
+    progress_hooks: Tuple[Callable[[Dict[str, str]], None], ...] = (
+        (partial(process_hook, updates_queue, req_id=req_id, throttle=ProgressThrottle()),)
+        if updates_queue is not None
+        else ()
+    )
 
-    tmp_out = Path(mkdtemp())
-    # Setting both the automatic subs and manual subs is fine, the youtube-dl will prefer manual subs if present
+    # The context manager is only entered below but the finalizer will still clean up if anything raises before then
+    workspace = TemporaryDirectory(prefix="ytarc-", dir=tmp_dir)
+    tmp_out = Path(workspace.name)
     ytdl_opt = {
-        "noplaylist": "true",
+        **_BASE_YTDL_OPT,
         "format": "bestvideo[vcodec^=avc1]+bestaudio/bestvideo+bestaudio/best" if download_video else "bestaudio/best",
         "outtmpl": str(tmp_out) + "/%(title)s.%(ext)s",
         "progress_hooks": progress_hooks,
-        "merge_output_format": "mkv",
-        "keepvideo": True if download_video else False,
+        "keepvideo": download_video,
         "postprocessors": postprocessors,
-        "logger": ytdl_logger,
-        "writesubtitles": True,
-        "writeautomaticsub": True,
-        "subtitleslangs": ["en"],
     }
 
-    if ffmpeg_dir:
+    if ffmpeg_dir is not None:
         ytdl_opt["ffmpeg_location"] = str(ffmpeg_dir)
 
-    try:
+    with workspace:
         with YoutubeDL(ytdl_opt) as ytdl:
             info = ytdl.extract_info(url, download=False)
             pretty_name = info["title"]
@@ -232,13 +410,78 @@ def download(
             except FileExistsError:
                 raise AlreadyDownloaded("File already downloaded", pretty_name)
 
-            with (tmp_out / "info.json").open("w") as f_out:
-                json.dump(info, f_out)
+            # Equivalent to `download_with_info_file` without round-tripping `info` through a JSON file.  youtube-dl
+            # writes the info JSON file itself thanks to "writeinfojson".
+            ytdl.process_ie_result(YoutubeDL.filter_requested_info(info), download=True)
+
+        return process_output_dir(tmp_out, output_dir, download_video, extract_audio, info)
+
+
+def download_in_subprocess(*args: Any, **kwargs: Any) -> DownloadResult:
+    """
+    Wrapper around :func:`download` for use in process pools, see it for the arguments.
+
+    youtube-dl's exceptions hold on to the traceback of what caused them, which can't be pickled back to the parent
+    process.  The parent would then only see a `TypeError` about pickling rather than the actual error, so any exception
+    is replaced with a plain one carrying the same message.
+
+    :return: Tuple containing information and finalized paths for all the files
+    """
+    try:
+        return download(*args, **kwargs)
+    except AlreadyDownloaded:
+        raise
+    except Exception as exc:  # noqa: B902
+        raise RuntimeError(str(exc)) from None
+
+
+def download_many(
+    output_dir: Path,
+    make_title_subdir: bool,
+    urls: Iterable[str],
+    download_video: bool,
+    extract_audio: bool,
+    audio_quality: int = 3,
+    ffmpeg_dir: Optional[Path] = None,
+    tmp_dir: Optional[Path] = None,
+    max_workers: int = 4,
+) -> Dict[str, Union[DownloadResult, BaseException]]:
+    """
+    Downloads multiple online video or audio clips concurrently, see :func:`download` for details.
 
-            ytdl.download_with_info_file(tmp_out / "info.json")
+    Each download runs in its own process as youtube-dl keeps global state (and we monkey patch it) so threads would
+    step on each other.  The executor queues the URLs so no more than `max_workers` downloads run at once.
+
+    :param output_dir: Desired output directory
+    :param make_title_subdir: Flag indicating whether to create a subdirectory in `output_dir` named after title
+    :param urls: The URLs to attempt to download, duplicates are only downloaded once
+    :param download_video: Flag indicating that the video should be downloaded
+    :param extract_audio: Flag indicating that a separate audio file (MP3) should be created
+    :param audio_quality: The MP3 VBR audio quality (1-5)
+    :param ffmpeg_dir: Path to the directory containing FFMPEG binaries
+    :param tmp_dir: Directory to create the temporary download workspaces in, defaults to the system temporary directory
+    :param max_workers: Maximum number of concurrent downloads
+    :return: Mapping of each URL to either its download results or the exception raised while downloading it
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            url: executor.submit(
+                download_in_subprocess,
+                output_dir,
+                make_title_subdir,
+                url,
+                download_video,
+                extract_audio,
+                audio_quality,
+                ffmpeg_dir=ffmpeg_dir,
+                tmp_dir=tmp_dir,
+            )
+            for url in dict.fromkeys(urls)
+        }
 
-        download_result = process_output_dir(tmp_out, output_dir, download_video, extract_audio)
-    finally:
-        shutil.rmtree(tmp_out)
+    results: Dict[str, Union[DownloadResult, BaseException]] = {}
+    for url, future in futures.items():
+        exc = future.exception()
+        results[url] = exc if exc is not None else future.result()
 
-    return download_result
+    return results
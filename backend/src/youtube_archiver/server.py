@@ -1,24 +1,202 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import logging
+import multiprocessing.queues
+import os
 import pathlib
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
 from json.decoder import JSONDecodeError
-from typing import Optional
+from operator import itemgetter
+from typing import Any, Deque, Dict, Optional, Tuple
 from uuid import uuid4
-from weakref import WeakSet
 
 from aiohttp import WSCloseCode, WSMsgType, web
-from janus import Queue
 
 from .custom_types import DownloadResult, UpdateMessage, UpdateStatusCode
-from .downloader import AlreadyDownloaded, download
+from .downloader import AlreadyDownloaded, download_in_subprocess
+
+try:
+    import orjson
+except ImportError:
+    # orjson comes with the "speedups" extra, it encodes the websocket messages several times faster than json
+
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj)
+
+else:
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop comes with the "speedups" extra (except on Windows), it's an event loop built on libuv
+
+    def _install_event_loop_policy() -> None:
+        pass
+
+else:
+
+    def _install_event_loop_policy() -> None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 
 logger = logging.getLogger(__name__)
 
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Download workers are started from scratch rather than forked from the server, which by then has the event loop and
+# several threads running that a forked child would inherit in an arbitrary state.
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Set in each download worker process by `init_download_worker`
+_worker_updates_queue: Optional[multiprocessing.queues.Queue[UpdateMessage]] = None
+
+
+def init_download_worker(
+    worker_updates_queue: multiprocessing.queues.Queue[UpdateMessage], log_level: int, ytdl_log_level: int
+) -> None:
+    """
+    Initializer for the download worker processes.  Stores the queue used to relay real-time updates to the server.
+
+    :mod:`multiprocessing` queues can't be passed as task arguments, they can only be inherited by new processes.
+    Spawned processes also start without the server's logging configuration so it's re-applied here.
+
+    :param worker_updates_queue: Queue drained by :func:`forward_worker_updates` in the server process
+    :param log_level: The server's root logging level
+    :param ytdl_log_level: The server's logging level for youtube-dl's messages
+    """
+    global _worker_updates_queue
+    _worker_updates_queue = worker_updates_queue
+
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    logging.getLogger("ytdl").setLevel(ytdl_log_level)
+    # Ctrl-C reaches the whole process group, the server shuts the workers down itself once running downloads finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def download_in_worker(
+    download_dir: pathlib.Path,
+    url: str,
+    download_video: bool,
+    extract_audio: bool,
+    audio_quality: int,
+    req_id: str,
+    ffmpeg_dir: Optional[pathlib.Path],
+    tmp_dir: Optional[pathlib.Path],
+) -> DownloadResult:
+    """
+    Runs :func:`download` in a download worker process, relaying its real-time updates back to the server process.
+
+    Goes through :func:`download_in_subprocess` so youtube-dl's errors reach the server process with their message.
+
+    :param download_dir: Local directory to store downloaded files in.
+    :param url: The URL to attempt to download
+    :param download_video: Flag indicating that the video should be downloaded
+    :param extract_audio: Flag indicating that a separate audio file (MP3) should be created
+    :param audio_quality: The MP3 VBR audio quality (1-5)
+    :param req_id: The request ID to include in all real-time updates
+    :param ffmpeg_dir: Directory containing the FFmpeg binaries.
+    :param tmp_dir: Directory to create temporary download workspaces in.
+    :return: Tuple containing information and finalized paths for all the files
+    """
+    return download_in_subprocess(
+        download_dir,
+        True,
+        url,
+        download_video,
+        extract_audio,
+        audio_quality,
+        _worker_updates_queue,
+        req_id,
+        ffmpeg_dir,
+        tmp_dir,
+    )
+
+
+class DownloadWorkers:
+    """
+    The pool of processes that downloads are run in.
+
+    A :class:`ProcessPoolExecutor` refuses all further work once one of its processes dies unexpectedly, e.g. killed by
+    the OOM killer, so the pool is replaced when that happens rather than failing every later download.
+    """
+
+    def __init__(self, worker_updates_queue: multiprocessing.queues.Queue[UpdateMessage]) -> None:
+        """
+        Constructor.
+
+        :param worker_updates_queue: Queue the download worker processes put their updates into
+        """
+        self._worker_updates_queue = worker_updates_queue
+        self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        """
+        Creates a new process pool.
+
+        :return: The new process pool
+        """
+        return ProcessPoolExecutor(
+            mp_context=_MP_CONTEXT,
+            initializer=init_download_worker,
+            initargs=(
+                self._worker_updates_queue,
+                logging.getLogger().getEffectiveLevel(),
+                logging.getLogger("ytdl").getEffectiveLevel(),
+            ),
+        )
+
+    def replace_broken(self, broken_executor: ProcessPoolExecutor) -> None:
+        """
+        Replaces the pool after one of its workers died, unless it was already replaced.
+
+        :param broken_executor: The pool that a :class:`BrokenProcessPool` came from
+        """
+        if self.executor is not broken_executor:
+            return
+
+        logger.warning("A download worker died unexpectedly, restarting the download workers")
+        self.executor = self._create_executor()
+        broken_executor.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        """Shuts down the current pool, waiting for running downloads to finish."""
+        self.executor.shutdown()
+
+
+def forward_worker_updates(
+    worker_updates_queue: multiprocessing.queues.Queue[UpdateMessage],
+    updates_queue: asyncio.Queue[UpdateMessage],
+    loop: asyncio.AbstractEventLoop,
+) -> None:
+    """
+    Relays real-time updates from the download worker processes to :func:`update_publisher`.
+
+    Meant to be run in a dedicated thread, returns once a `None` sentinel is received.
+
+    :param worker_updates_queue: Queue the download worker processes put their updates into
+    :param updates_queue: Queue consumed by :func:`update_publisher`
+    :param loop: The event loop `updates_queue` belongs to
+    """
+    while True:
+        update = worker_updates_queue.get()
+        if update is None:
+            break
+
+        # asyncio queues aren't thread-safe, the put has to happen on the event loop's thread
+        loop.call_soon_threadsafe(updates_queue.put_nowait, update)
+
 
 async def update_publisher(app: web.Application) -> None:
     """
@@ -30,10 +208,10 @@ async def update_publisher(app: web.Application) -> None:
     """
     try:
         while True:
-            update = await app["updates_queue"].async_q.get()
-            if update["status"] in [UpdateStatusCode.DOWNLOADING, UpdateStatusCode.DOWNLOADED]:
+            update = await app["updates_queue"].get()
+            if update["status"] in (UpdateStatusCode.DOWNLOADING, UpdateStatusCode.DOWNLOADED):
                 # Squash the directory where the file is being downloaded to
-                update["filename"] = update["filename"].name
+                update["filename"] = os.path.basename(update["filename"])
             elif update["status"] == UpdateStatusCode.COMPLETED:
                 # Hide the full directory and instead substitute user-accessible path. If download_dir is
                 # /var/www/html/downloads, result is in /var/www/html/downloads/Awesome, and download_prefix is
@@ -51,44 +229,141 @@ async def update_publisher(app: web.Application) -> None:
                 ).as_posix()
                 update["path"] = (app["download_prefix"] / update["path"].relative_to(app["download_dir"])).as_posix()
 
-            update["status"] = update["status"].name
-            # The websocket updates are best effort, not required.  Don't wait for it to finish
-            [asyncio.create_task(ws.send_json(update)) for ws in app["websockets"]]
+            # Serialize once rather than once per websocket
+            payload = _dumps(update)
+            # Each client's sender task drains its own queue so a slow client doesn't hold up the others
+            progress_key = None
+            if update["status"] == UpdateStatusCode.DOWNLOADING:
+                progress_key = (update.get("req_id", ""), update["filename"])
+            for send_queue in app["websockets"].values():
+                send_queue.put(payload, progress_key)
     except asyncio.CancelledError:
         pass
 
 
+def available_download(download_prefix: pathlib.Path, key: str) -> Dict[str, str]:
+    """
+    Creates the description of an available download sent to newly connected websockets.
+
+    :param download_prefix: Prefix for returned file paths, ultimately used to create download links.
+    :param key: The download's key, i.e. its directory name within the download directory
+    :return: Dictionary with keys: path, key, and pretty_name
+    """
+    return {"path": (download_prefix / key).as_posix(), "key": key, "pretty_name": key}
+
+
+def scan_available_downloads(download_dir: pathlib.Path, download_prefix: pathlib.Path) -> Dict[str, Dict[str, str]]:
+    """
+    Scans the download directory for completed downloads.
+
+    :param download_dir: Local directory downloaded files are stored in.
+    :param download_prefix: Prefix for returned file paths, ultimately used to create download links.
+    :return: Mapping of download key to its :func:`available_download` description
+    """
+    available_downloads = {}
+    with os.scandir(download_dir) as children:
+        for child in children:
+            if not child.is_dir():
+                continue
+
+            # Directories are made as hobo semaphore, it needs a .json file in it to actually have results.
+            with os.scandir(child.path) as files:
+                if not any(f.name.endswith(".json") for f in files):
+                    continue
+
+            available_downloads[child.name] = available_download(download_prefix, child.name)
+
+    return available_downloads
+
+
+class WebsocketSendQueue:
+    """
+    Queue of serialized updates waiting to be sent to one websocket.
+
+    Progress updates are coalesced: while one for a file is still waiting to be sent, a newer one replaces it in place
+    rather than queueing behind it.  A slow client therefore holds at most one progress update per file being
+    downloaded.  Every other update is always delivered, those pile up (one per finished request, downloaded file, or
+    deleted download) until the client catches up or disconnects.
+    """
+
+    def __init__(self) -> None:
+        """Constructor."""
+        # (progress key, payload) pairs, a progress update's payload lives in `_progress` so it can be replaced
+        self._pending: Deque[Tuple[Optional[Tuple[str, str]], str]] = deque()
+        self._progress: Dict[Tuple[str, str], str] = {}
+        self._ready = asyncio.Event()
+
+    def put(self, payload: str, progress_key: Optional[Tuple[str, str]] = None) -> None:
+        """
+        Queues an update.
+
+        :param payload: The serialized update message.
+        :param progress_key: (request ID, filename) of a progress update, `None` for every other update.
+        """
+        if progress_key is None:
+            self._pending.append((None, payload))
+        else:
+            if progress_key not in self._progress:
+                self._pending.append((progress_key, ""))
+            self._progress[progress_key] = payload
+
+        self._ready.set()
+
+    async def get(self) -> str:
+        """
+        Waits for and removes the oldest queued update.
+
+        :return: The serialized update message.
+        """
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+
+        progress_key, payload = self._pending.popleft()
+        if progress_key is not None:
+            payload = self._progress.pop(progress_key)
+
+        return payload
+
+
+async def websocket_sender(ws: web.WebSocketResponse, send_queue: WebsocketSendQueue) -> None:
+    """
+    Per-websocket task that sends the updates queued for it by :func:`update_publisher`.
+
+    :param ws: The websocket to send to.
+    :param send_queue: Queue of update messages destined for `ws`.
+    """
+    while not ws.closed:
+        payload = await send_queue.get()
+        try:
+            await ws.send_str(payload)
+        except ConnectionResetError:
+            break
+
+
 async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
     """
     Handler for "status" websockets.  Sends a one-time list of available downloads, :func:`update_publisher` does rest.
 
+    The list of available downloads is served from the in-memory cache rather than re-scanning the download directory.
+
     :param request: The incoming (empty) request
     :return: :mod:`aiohttp` mandated response type
     """
     ws = web.WebSocketResponse(heartbeat=5)
     await ws.prepare(request)
 
-    request.app["websockets"].add(ws)
-
-    available_downloads = []
-    for child in request.app["download_dir"].iterdir():
-        # Directories are made as hobo semaphore, it needs a .json file in it to actually have results.
-        if not child.is_dir() or len(list(child.glob("*.json"))) == 0:
-            continue
-
-        available_downloads.append(
-            {
-                "path": (request.app["download_prefix"] / child.relative_to(request.app["download_dir"])).as_posix(),
-                "key": child.name,
-                "pretty_name": child.name,
-            }
-        )
+    # Register before sending the list of downloads so no update is missed, they're queued until the sender starts
+    send_queue = WebsocketSendQueue()
+    request.app["websockets"][ws] = send_queue
 
     # Sort the downloads in alphabetical order
-    available_downloads.sort(key=lambda x: x["pretty_name"])
+    available_downloads = sorted(request.app["available_downloads"].values(), key=itemgetter("pretty_name"))
 
-    await ws.send_json({"downloads": available_downloads, "status": "CONNECTED"})
+    sender = None
     try:
+        await ws.send_json({"downloads": available_downloads, "status": "CONNECTED"})
+        sender = asyncio.create_task(websocket_sender(ws, send_queue))
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
                 if msg.data == "close":
@@ -99,24 +374,34 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
             elif msg.type in [WSMsgType.CLOSED, WSMsgType.ERROR]:
                 break
     finally:
-        request.app["websockets"].discard(ws)
+        del request.app["websockets"][ws]
+        if sender is not None:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
 
     return ws
 
 
 def download_future_handler(
-    updates_queue: Queue[UpdateMessage], req_id: str, future: asyncio.Future[DownloadResult]
+    app: web.Application, req_id: str, executor: ProcessPoolExecutor, future: asyncio.Future[DownloadResult]
 ) -> None:
     """
     Filters out `AlreadyDownloaded` from executor calls to `download`.  Propagates all other exceptions.
 
-    :param updates_queue: A queue to put real-time updates into
+    Successful downloads are also added to the cache of available downloads and a broken `executor` is replaced.
+
+    :param app: Reference to the overall application.
     :param req_id: The request ID attached to this request
+    :param executor: The download process pool the request was run in
     :param future: The future itself
     """
+    updates_queue: asyncio.Queue[UpdateMessage] = app["updates_queue"]
     try:
         download_result = future.result()
-        updates_queue.sync_q.put_nowait(
+        app["available_downloads"][download_result.key] = available_download(
+            app["download_prefix"], download_result.key
+        )
+        updates_queue.put_nowait(
             {
                 "req_id": req_id,
                 "status": UpdateStatusCode.COMPLETED,
@@ -129,12 +414,16 @@ def download_future_handler(
             }
         )
     except AlreadyDownloaded as exc:
-        updates_queue.sync_q.put_nowait(
+        updates_queue.put_nowait(
             {"status": UpdateStatusCode.ERROR, "msg": f'"{exc.key}" already downloaded', "req_id": req_id}
         )
         logger.info('Request %s for "%s" was already downloaded', req_id, exc.key)
+    except BrokenProcessPool as exc:
+        updates_queue.put_nowait({"status": UpdateStatusCode.ERROR, "msg": str(exc), "req_id": req_id})
+        logger.error("Request %s failed as its download worker died", req_id)
+        app["download_workers"].replace_broken(executor)
     except Exception as exc:  # noqa: B902
-        updates_queue.sync_q.put_nowait({"status": UpdateStatusCode.ERROR, "msg": str(exc), "req_id": req_id})
+        updates_queue.put_nowait({"status": UpdateStatusCode.ERROR, "msg": str(exc), "req_id": req_id})
         logger.info("Request %s got an exception", req_id, exc_info=True)
 
 
@@ -152,42 +441,56 @@ async def download_handler(request: web.Request) -> web.Response:
     except JSONDecodeError:
         raise web.HTTPBadRequest(text="Request body must be JSON")
 
-    if not isinstance(req_params.get("url"), str):
+    if not isinstance(req_params, dict):
+        raise web.HTTPBadRequest(text="Request body must be a JSON object")
+
+    url = req_params.get("url")
+    if not isinstance(url, str):
         raise web.HTTPBadRequest(text='"url" must be specified and be a string')
 
-    if not isinstance(req_params.get("download_video"), bool):
+    download_video = req_params.get("download_video")
+    if not isinstance(download_video, bool):
         raise web.HTTPBadRequest(text='"download_video" must be specified and be a boolean')
 
-    if not isinstance(req_params.get("extract_audio"), bool):
+    extract_audio = req_params.get("extract_audio")
+    if not isinstance(extract_audio, bool):
         raise web.HTTPBadRequest(text='"extract_audio" must be specified and be a boolean')
 
-    if not isinstance(req_params.get("audio_quality", 3), int) or not 1 <= req_params.get("quality_quality", 3) <= 5:
+    audio_quality = req_params.get("audio_quality", 3)
+    # bool is a subclass of int but true/false aren't meaningful qualities
+    if not isinstance(audio_quality, int) or isinstance(audio_quality, bool) or not 1 <= audio_quality <= 5:
         raise web.HTTPBadRequest(text='"audio_quality" must be between 1-5')
 
     req_id = str(uuid4())
-
-    future = loop.run_in_executor(
-        request.app["executor"],
-        download,
+    download_args = (
         pathlib.Path(request.app["download_dir"]),
-        True,
-        req_params["url"],
-        req_params.get("download_video"),
-        req_params.get("extract_audio"),
-        req_params.get("audio_quality", 3),
-        request.app["updates_queue"],
+        url,
+        download_video,
+        extract_audio,
+        audio_quality,
         req_id,
         request.app["ffmpeg_dir"],
+        request.app["tmp_dir"],
     )
+
+    download_workers: DownloadWorkers = request.app["download_workers"]
+    executor = download_workers.executor
+    try:
+        future = loop.run_in_executor(executor, download_in_worker, *download_args)
+    except BrokenProcessPool:
+        # A worker died and the futures that would have replaced the pool haven't been handled yet
+        download_workers.replace_broken(executor)
+        executor = download_workers.executor
+        future = loop.run_in_executor(executor, download_in_worker, *download_args)
     # typeshed has a bug, see https://github.com/python/typeshed/pull/3935
-    future.add_done_callback(partial(download_future_handler, request.app["updates_queue"], req_id))  # type: ignore
+    future.add_done_callback(partial(download_future_handler, request.app, req_id, executor))  # type: ignore
 
     return web.json_response({"req_id": req_id}, status=202)
 
 
 async def delete_handler(request: web.Request) -> web.Response:
     """
-    Handles requests to delete a particular result.  The input directory is checked for path traversal attacks.
+    Handles requests to delete a particular result.  The key is checked for path traversal attacks.
 
     :param request: JSON request with keys: key
     :return: :mod:`aiohttp` mandated response type: 200 on success or 400 on bad request parameters
@@ -197,32 +500,50 @@ async def delete_handler(request: web.Request) -> web.Response:
     except JSONDecodeError:
         raise web.HTTPBadRequest(text="Request body must be JSON")
 
-    if not isinstance(req_params.get("key"), str):
+    if not isinstance(req_params, dict) or not isinstance(req_params.get("key"), str):
         raise web.HTTPBadRequest(text='"key" must be specified and be a string')
 
-    resolved_dir = (request.app["download_dir"] / pathlib.Path(req_params.get("key"))).resolve()
-    try:
-        resolved_dir.relative_to(request.app["download_dir"])
-    except ValueError:
+    # Keys are always a single directory name directly under the download directory so there's no need to resolve
+    # (and stat every component of) the path to prevent path traversal, just reject anything that isn't a plain name.
+    key = req_params["key"]
+    if key in ("", os.curdir, os.pardir) or os.sep in key or (os.altsep and os.altsep in key) or "\0" in key:
+        raise web.HTTPBadRequest(text="key specified is forbidden")
+
+    target_dir = request.app["download_dir"] / key
+    # Downloads are never symlinks and one could point outside of the download directory
+    if target_dir.is_symlink():
         raise web.HTTPBadRequest(text="key specified is forbidden")
 
-    if resolved_dir.is_dir():
-        shutil.rmtree(resolved_dir)
-    else:
+    if not target_dir.is_dir():
+        raise web.HTTPBadRequest(text="key does not exist")
+
+    # Removing a download can take a while, don't block the event loop (and every other websocket) while doing it
+    try:
+        await asyncio.get_running_loop().run_in_executor(request.app["executor"], shutil.rmtree, target_dir)
+    except FileNotFoundError:
+        # A concurrent request removed it first
         raise web.HTTPBadRequest(text="key does not exist")
+    request.app["available_downloads"].pop(key, None)
 
-    request.app["updates_queue"].sync_q.put_nowait({"status": UpdateStatusCode.DELETED, "key": req_params["key"]})
+    request.app["updates_queue"].put_nowait({"status": UpdateStatusCode.DELETED, "key": key})
 
     return web.Response(status=200)
 
 
 async def start_background_tasks(app: web.Application) -> None:
     """
-    Startup function for aiohttp.  Kicks off the update publisher in the background.
+    Startup function for aiohttp.  Kicks off the update publisher and the worker update forwarder in the background.
 
     :param app: Reference to the overall application.
     """
     app["update_publisher"] = asyncio.create_task(update_publisher(app))
+    app["update_forwarder"] = threading.Thread(
+        target=forward_worker_updates,
+        args=(app["worker_updates_queue"], app["updates_queue"], asyncio.get_running_loop()),
+        name="update-forwarder",
+        daemon=True,
+    )
+    app["update_forwarder"].start()
 
 
 async def cleanup_background_tasks(app: web.Application) -> None:
@@ -232,25 +553,46 @@ async def cleanup_background_tasks(app: web.Application) -> None:
     :param app: Reference to the overall application.
     """
     app["executor"].shutdown()
+    app["download_workers"].shutdown()
+    # Let the forwarder relay whatever the workers last sent before the publisher is stopped
+    app["worker_updates_queue"].put(None)
+    app["update_forwarder"].join()
     app["update_publisher"].cancel()
     await app["update_publisher"]
 
-    for ws in set(app["websockets"]):
+    for ws in list(app["websockets"]):
         await ws.close(code=WSCloseCode.GOING_AWAY, message="Server shutdown")
 
 
 async def init_queue(app: web.Application) -> None:
     """
-    Janus Queues require the asyncio event loop to be running so this creations needs to be done in a start-up handler
-    rather than the synchronous `server` function.
+    Creates the queue of updates destined for the websockets.
+
+    asyncio Queues bind to the running event loop (on older Pythons) so this creation needs to be done in a start-up
+    handler rather than the synchronous `server` function.
+
+    :param app: Reference to the overall application.
+    """
+    app["updates_queue"] = asyncio.Queue()
+
+
+async def init_available_downloads(app: web.Application) -> None:
+    """
+    Startup function for aiohttp.  Populates the cache of available downloads with a single scan of the download dir.
 
     :param app: Reference to the overall application.
     """
-    app["updates_queue"] = Queue()
+    app["available_downloads"] = await asyncio.get_running_loop().run_in_executor(
+        app["executor"], scan_available_downloads, app["download_dir"], app["download_prefix"]
+    )
 
 
 def server(
-    download_dir: pathlib.Path, download_prefix: str, port: int, ffmpeg_dir: Optional[pathlib.Path] = None
+    download_dir: pathlib.Path,
+    download_prefix: str,
+    port: int,
+    ffmpeg_dir: Optional[pathlib.Path] = None,
+    tmp_dir: Optional[pathlib.Path] = None,
 ) -> None:
     """
     Starts the API server.
@@ -259,16 +601,19 @@ def server(
     :param download_prefix: Prefix for returned file paths, ultimately used to create download links.
     :param port: TCP port to bind on.
     :param ffmpeg_dir: Directory containing the FFmpeg binaries.
+    :param tmp_dir: Directory to create temporary download workspaces in, defaults to the system temporary directory.
     """
     app = web.Application()
     app.on_startup.append(init_queue)
+    app.on_startup.append(init_available_downloads)
     app.on_startup.append(start_background_tasks)
     app.on_cleanup.append(cleanup_background_tasks)
 
     app["download_dir"] = download_dir
     app["download_prefix"] = pathlib.Path(download_prefix)
     app["ffmpeg_dir"] = ffmpeg_dir
-    app["websockets"] = WeakSet()
+    app["tmp_dir"] = tmp_dir
+    app["websockets"] = {}
 
     app.add_routes(
         [
@@ -278,6 +623,14 @@ def server(
         ]
     )
 
+    # Downloads run in separate processes so youtube-dl's extractors don't compete with the event loop for the GIL.  The
+    # thread pool is for filesystem operations that would otherwise block the event loop.
+    worker_updates_queue: multiprocessing.queues.Queue[UpdateMessage] = _MP_CONTEXT.Queue()
+    app["worker_updates_queue"] = worker_updates_queue
+
     with ThreadPoolExecutor() as executor:
         app["executor"] = executor
+        # Shut down by `cleanup_background_tasks`
+        app["download_workers"] = DownloadWorkers(worker_updates_queue)
+        _install_event_loop_policy()
         web.run_app(app, port=port)